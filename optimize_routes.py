@@ -1,13 +1,28 @@
 import os
+import sqlite3
+from contextlib import closing
 import requests
 import numpy as np
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from ortools.constraint_solver import pywrapcp, routing_enums_pb2
 from math import radians, cos, sin, asin, sqrt
-from functools import partial
 from concurrent.futures import ThreadPoolExecutor
 
 MATRIX_WORKERS = 32
+# One pooled keep-alive session shared by all matrix workers. The pool must be
+# at least as large as the worker count, otherwise urllib3 discards surplus
+# connections and every extra worker pays a fresh TCP handshake per request.
+# Bike and car matrices are built concurrently, hence room for two pools' worth.
 _session = requests.Session()
+_session.mount(
+    "http://",
+    HTTPAdapter(
+        pool_connections=MATRIX_WORKERS,
+        pool_maxsize=2 * MATRIX_WORKERS,
+        max_retries=Retry(total=2, backoff_factor=0.1),
+    ),
+)
 
 GRAPHHOPPER_URL = "http://localhost:8989"
 DEPOT = (56.161147, 10.13455)
@@ -19,6 +34,22 @@ DEPOT_INDEX = 0
 CENTER_COORD = (56.15625426608341, 10.214135214922244)
 CENTER_RADIUS_M = 2000
 CENTER_PENALTY_MINUTES = 20
+# Guided local search never stops on its own, so the time limit is the whole
+# solve budget. Scale it with the number of stops instead of always burning
+# the maximum on small days.
+MIN_SOLVE_SECONDS = 5
+MAX_SOLVE_SECONDS = 120
+# Profiles whose pairwise matrix is built from the upper triangle only and
+# mirrored, halving the /route calls. Cars stay asymmetric because one-way
+# streets matter. The bike profile's elevation model makes uphill legs a bit
+# slower than downhill ones, which is accepted at city-wide distances.
+SYMMETRIC_MODES = {"bike"}
+# Persistent (mode, origin, destination) → (minutes, km) store for the
+# per-pair fallback. Most stops recur from day to day, so only pairs involving
+# new coordinates hit GraphHopper. Cleared when the map is re-downloaded.
+# This relative default is for local runs; the robot passes a path next to the
+# map so the cache survives a fresh checkout.
+PAIR_CACHE_PATH = os.path.join("matrix_cache", "pairs.sqlite")
 
 # Large finite sentinel for unreachable arcs. Keeping this a plain Python int
 # (not float("inf"), not a numpy scalar) avoids two separate failure modes:
@@ -29,12 +60,21 @@ CENTER_PENALTY_MINUTES = 20
 #      just get bad answers you can't easily see.
 # 1e9 is vastly beyond any realistic route so the solver will always avoid it.
 UNREACHABLE = 10 ** 9
+# GraphHopper errors that mean "there is no route", as opposed to "try again".
+# They are reported as 4xx with the exception class in the hint details.
+NO_ROUTE_ERRORS = ("PointNotFoundException", "PointOutOfBoundsException", "ConnectionNotFoundException")
 
 
-def get_travel_data(coord1, coord2, mode):
+def get_travel_data(coord1, coord2, mode, session=None):
     """Return (duration_minutes, distance_km) as plain Python floats.
-    Failed lookups return a large finite sentinel — never inf, never numpy —
-    because both can silently corrupt downstream OR-Tools behavior."""
+    When GraphHopper answers that no route exists (a point it can't snap, or
+    no connection between the two) both values are a large finite sentinel —
+    never inf, never numpy — because both can silently corrupt downstream
+    OR-Tools behavior. Returns None for failures that may not repeat
+    (timeouts, connection errors, server errors), so callers don't cache them.
+    Pass `session` to reuse a specific pooled connection; defaults to the
+    module-level session."""
+    session = session or _session
     params = {
         "point": [f"{coord1[0]},{coord1[1]}", f"{coord2[0]},{coord2[1]}"],
         "profile": mode,
@@ -42,81 +82,256 @@ def get_travel_data(coord1, coord2, mode):
         "calc_points": "false",
     }
     try:
-        r = _session.get(f"{GRAPHHOPPER_URL}/route", params=params, timeout=10)
+        r = session.get(f"{GRAPHHOPPER_URL}/route", params=params, timeout=10)
+        data = r.json()
+    except Exception:
+        return None
+
+    if r.status_code == 200 and data.get("paths"):
+        duration = float(data["paths"][0]["time"]) / 60000.0  # minutes
+        distance = float(data["paths"][0]["distance"]) / 1000.0  # km
+        return duration, distance
+    if 400 <= r.status_code < 500:
+        details = " ".join(str(hint.get("details", "")) for hint in data.get("hints", []))
+        if any(error in details for error in NO_ROUTE_ERRORS):
+            return float(UNREACHABLE), float(UNREACHABLE)
+    return None
+
+
+def create_distance_matrix_batch(locations, mode, session=None):
+    """Fetch the full time/distance matrix in one POST to GraphHopper's /matrix.
+    Returns two float64 ndarrays (minutes, km), or None if the server has no
+    matrix endpoint (the open-source GraphHopper build does not ship it) so
+    the caller can fall back to per-pair /route calls.
+    Unreachable cells come back as null and are mapped to UNREACHABLE."""
+    session = session or _session
+    body = {
+        # GraphHopper's JSON APIs take points as [lon, lat].
+        "points": [[lon, lat] for lat, lon in locations],
+        "profile": mode,
+        "out_arrays": ["times", "distances"],
+        "fail_fast": False,
+    }
+    try:
+        r = session.post(f"{GRAPHHOPPER_URL}/matrix", json=body, timeout=120)
         r.raise_for_status()
         data = r.json()
-        if "paths" in data:
-            duration = float(data["paths"][0]["time"]) / 60000.0  # minutes
-            distance = float(data["paths"][0]["distance"]) / 1000.0  # km
-            return duration, distance
+        # null → NaN under a float dtype.
+        times = np.array(data["times"], dtype=np.float64)  # seconds
+        distances = np.array(data["distances"], dtype=np.float64)  # meters
     except Exception:
-        pass
-    return float(UNREACHABLE), float(UNREACHABLE)
+        return None
 
+    time_matrix = np.where(np.isnan(times), UNREACHABLE, times / 60.0)
+    dist_matrix = np.where(np.isnan(distances), UNREACHABLE, distances / 1000.0)
+    return time_matrix, dist_matrix
 
-def create_distance_matrix(locations, mode, use_cache=False, cache_folder="matrix_cache"):
-    """Returns two nested lists of pure Python floats — never numpy scalars.
-    OR-Tools callbacks are SWIG-wrapped and can silently misread numpy types
-    (no exception, just wrong routes), so we strip numpy at the boundary here
-    and the callbacks float()-cast again as belt-and-braces."""
-    os.makedirs(cache_folder, exist_ok=True)
-    cache_file = os.path.join(cache_folder, f"{mode}_matrix_{len(locations)}.npz")
 
-    if use_cache and os.path.exists(cache_file):
-        data = np.load(cache_file)
-        # .item() forces numpy scalar → native Python float.
-        time_m = [[float(cell) for cell in row] for row in data["time"].tolist()]
-        dist_m = [[float(cell) for cell in row] for row in data["dist"].tolist()]
-        return time_m, dist_m
+def open_pair_cache(path=PAIR_CACHE_PATH):
+    """Open the persistent per-pair travel cache, creating it if needed."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS pairs ("
+        "mode TEXT, origin TEXT, destination TEXT, minutes REAL, km REAL, "
+        "PRIMARY KEY (mode, origin, destination))"
+    )
+    return conn
+
+
+def clear_pair_cache(path=PAIR_CACHE_PATH):
+    """Forget every cached pair, e.g. after the road network has changed."""
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _coord_key(coord):
+    # ~1 m precision: the same address geocoded twice maps to the same key.
+    return f"{coord[0]:.5f},{coord[1]:.5f}"
+
+
+def _pair_key(keys, i, j, symmetric):
+    """Cache (origin, destination) for pair (i, j). A symmetric mode stores each
+    pair once under a fixed key order, so the lookup does not depend on the
+    order the stops happen to arrive in."""
+    if symmetric and keys[j] < keys[i]:
+        return keys[j], keys[i]
+    return keys[i], keys[j]
+
+
+def _cached_pair(pair_cache, mode, origin, destination):
+    return pair_cache.execute(
+        "SELECT minutes, km FROM pairs WHERE mode = ? AND origin = ? AND destination = ?",
+        (mode, origin, destination),
+    ).fetchone()
 
-    size = len(locations)
-    time_matrix = [[0.0] * size for _ in range(size)]
-    dist_matrix = [[0.0] * size for _ in range(size)]
 
-    # Build list of all off-diagonal (i, j) pairs and fetch in parallel
-    pairs = [(i, j) for i in range(size) for j in range(size) if i != j]
+def _routable_pairs(locations, mode, symmetric):
+    """Return the (i, j) pairs that need a GraphHopper route, and for bikes
+    the boolean mask of pairs that are out of range (None otherwise)."""
+    size = len(locations)
+    if symmetric:
+        pairs = [(i, j) for i in range(size) for j in range(i + 1, size)]
+    else:
+        pairs = [(i, j) for i in range(size) for j in range(size) if i != j]
+
+    too_far = None
+    if mode == "bike":
+        # Road distance is never shorter than the straight line, so a pair
+        # further apart than a bike's whole daily range can never be on a bike
+        # route. Mark it unreachable without asking GraphHopper.
+        lats, lons = np.asarray(locations, dtype=np.float64).T
+        too_far = haversine_vec(lats[:, None], lons[:, None], lats[None, :], lons[None, :]) > MAX_BIKE_KM * 1000
+        pairs = [(i, j) for i, j in pairs if not too_far[i, j]]
+    return pairs, too_far
+
+
+def matrices_cached(locations, profiles, pair_cache_path=PAIR_CACHE_PATH):
+    """True if the pair cache already holds every route solve_vrp would need
+    for these stops and profiles, i.e. the solve can run without GraphHopper."""
+    all_coords = [DEPOT] + [loc["coord"] for loc in locations]
+    keys = [_coord_key(c) for c in all_coords]
+    with closing(open_pair_cache(pair_cache_path)) as pair_cache:
+        for mode in profiles:
+            symmetric = mode in SYMMETRIC_MODES
+            pairs, _ = _routable_pairs(all_coords, mode, symmetric)
+            if any(_cached_pair(pair_cache, mode, *_pair_key(keys, i, j, symmetric)) is None for i, j in pairs):
+                return False
+    return True
+
+
+def create_distance_matrix_pairwise(locations, mode, symmetric=False, pair_cache=None):
+    """Fallback for servers without /matrix: one /route call per off-diagonal
+    (i, j) pair, fetched in parallel over the pooled session. With
+    `symmetric`, only i < j is fetched and mirrored into (j, i). With a
+    `pair_cache` connection (see open_pair_cache), known pairs are read from
+    it and newly routed ones written back."""
+    size = len(locations)
+    time_matrix = np.zeros((size, size), dtype=np.float64)
+    dist_matrix = np.zeros((size, size), dtype=np.float64)
+
+    def store(i, j, t, d):
+        time_matrix[i, j] = t
+        dist_matrix[i, j] = d
+        if symmetric:
+            time_matrix[j, i] = t
+            dist_matrix[j, i] = d
+
+    pairs, too_far = _routable_pairs(locations, mode, symmetric)
+    if too_far is not None:
+        time_matrix[too_far] = UNREACHABLE
+        dist_matrix[too_far] = UNREACHABLE
+
+    keys = [_coord_key(c) for c in locations]
+    if pair_cache is not None:
+        missing = []
+        for i, j in pairs:
+            row = _cached_pair(pair_cache, mode, *_pair_key(keys, i, j, symmetric))
+            if row is None:
+                missing.append((i, j))
+            else:
+                store(i, j, *row)
+        pairs = missing
 
     def fetch(pair):
         i, j = pair
-        t, d = get_travel_data(locations[i], locations[j], mode)
-        return i, j, t, d
+        return i, j, get_travel_data(locations[i], locations[j], mode, _session)
 
+    fetched = []
     with ThreadPoolExecutor(max_workers=MATRIX_WORKERS) as pool:
-        for i, j, t, d in pool.map(fetch, pairs):
-            time_matrix[i][j] = float(t)
-            dist_matrix[i][j] = float(d)
+        for i, j, travel in pool.map(fetch, pairs):
+            if travel is None:
+                # Possibly just a timeout: route around it today, but don't
+                # persist it.
+                store(i, j, UNREACHABLE, UNREACHABLE)
+            else:
+                # Includes definite "no route" answers, so a stop GraphHopper
+                # can never reach doesn't count as uncached every day.
+                store(i, j, *travel)
+                fetched.append((mode, *_pair_key(keys, i, j, symmetric), *travel))
+
+    if pair_cache is not None and fetched:
+        with pair_cache:
+            pair_cache.executemany("INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?, ?)", fetched)
 
-    if use_cache:
-        np.savez_compressed(cache_file, time=time_matrix, dist=dist_matrix)
     return time_matrix, dist_matrix
 
 
-def time_callback(from_index, to_index, matrix, vtype, manager, coords):
-    from_node = manager.IndexToNode(from_index)
-    to_node = manager.IndexToNode(to_index)
+def create_distance_matrix(
+    locations, mode, use_cache=False, cache_folder="matrix_cache", symmetric=False, pair_cache_path=PAIR_CACHE_PATH, cached_only=False
+):
+    """Returns (time_minutes, distance_km) as two N x N float ndarrays.
+    With `cached_only` (GraphHopper not started, see matrices_cached) every
+    pair is read from the pair cache and no request is made.
+    These must not be handed to OR-Tools directly: its SWIG layer can
+    silently misread numpy scalars (no exception, just wrong routes), so the
+    transit builders below convert to native Python ints at the boundary."""
+    # Raw float32 .npy files: minutes/km need nowhere near float64 precision,
+    # there is no zlib pass on save/load, and np.load can memory-map them.
+    time_file = os.path.join(cache_folder, f"{mode}_time_{len(locations)}.npy")
+    dist_file = os.path.join(cache_folder, f"{mode}_dist_{len(locations)}.npy")
+
+    if use_cache and os.path.exists(time_file) and os.path.exists(dist_file):
+        return np.load(time_file, mmap_mode="r"), np.load(dist_file, mmap_mode="r")
+
+    matrices = None if cached_only else create_distance_matrix_batch(locations, mode)
+    if matrices is None:
+        with closing(open_pair_cache(pair_cache_path)) as pair_cache:
+            matrices = create_distance_matrix_pairwise(locations, mode, symmetric, pair_cache)
+    time_matrix, dist_matrix = matrices
 
-    # float() cast before arithmetic, int() cast on return: forces the value
-    # through native Python types so OR-Tools' SWIG layer can't silently
-    # misread a numpy scalar as garbage.
-    base_time = float(matrix[from_node][to_node])
-    service_time = STOP_TIME if to_node != DEPOT_INDEX else 0
-    penalty = (
-        CENTER_PENALTY_MINUTES
-        if vtype == "car" and haversine(coords[to_node], CENTER_COORD) < CENTER_RADIUS_M
-        else 0
-    )
-    total = base_time + service_time + penalty
-    return min(int(total), UNREACHABLE)
-
-
-def distance_callback(from_index, to_index, matrix, manager):
-    from_node = manager.IndexToNode(from_index)
-    to_node = manager.IndexToNode(to_index)
-    meters = float(matrix[from_node][to_node]) * 1000.0
-    return min(int(meters), UNREACHABLE)
+    if use_cache:
+        os.makedirs(cache_folder, exist_ok=True)
+        np.save(time_file, time_matrix.astype(np.float32))
+        np.save(dist_file, dist_matrix.astype(np.float32))
+    return time_matrix, dist_matrix
 
 
-def solve_vrp(locations, vehicles_config, use_cache=False):
+def build_matrices_for_profiles(all_coords, profiles, use_cache=False, pair_cache_path=PAIR_CACHE_PATH, cached_only=False):
+    """Build {profile: (time_matrix, dist_matrix)} for every profile at once.
+    The profiles are independent, so a bike + car day waits for the slower
+    of the two matrix builds instead of both back to back."""
+    profiles = sorted(profiles)
+    if not profiles:
+        return {}
+    with ThreadPoolExecutor(max_workers=len(profiles)) as pool:
+        futures = {
+            profile: pool.submit(
+                create_distance_matrix,
+                all_coords,
+                profile,
+                use_cache,
+                symmetric=profile in SYMMETRIC_MODES,
+                pair_cache_path=pair_cache_path,
+                cached_only=cached_only,
+            )
+            for profile in profiles
+        }
+        return {profile: future.result() for profile, future in futures.items()}
+
+
+def build_time_transits(matrix, vtype, near_center):
+    """Bake travel time, per-stop service time and the car centre penalty into
+    one integer matrix (minutes) for RegisterTransitMatrix, so the solver reads
+    arc costs from C++ instead of calling back into Python for every arc.
+
+    The final .tolist() is the numpy → OR-Tools boundary: every cell comes out
+    as a native Python int, which SWIG can't misread."""
+    extra = np.full(len(matrix), STOP_TIME, dtype=np.float64)
+    extra[DEPOT_INDEX] = 0
+    if vtype == "car":
+        extra[near_center] += CENTER_PENALTY_MINUTES
+    total = np.asarray(matrix, dtype=np.float64) + extra[None, :]
+    return np.minimum(np.trunc(total), UNREACHABLE).astype(np.int64).tolist()
+
+
+def build_distance_transits(matrix):
+    """Convert a km matrix to the integer meters RegisterTransitMatrix expects."""
+    meters = np.asarray(matrix, dtype=np.float64) * 1000.0
+    return np.minimum(np.trunc(meters), UNREACHABLE).astype(np.int64).tolist()
+
+
+def solve_vrp(locations, vehicles_config, use_cache=False, pair_cache_path=PAIR_CACHE_PATH, cached_only=False):
     all_coords = [DEPOT] + [loc["coord"] for loc in locations]
 
     num_bikes = vehicles_config.get("bikes", 0)
@@ -124,24 +339,32 @@ def solve_vrp(locations, vehicles_config, use_cache=False):
     vehicle_count = num_bikes + num_cars
     vehicle_types = ["bike"] * num_bikes + ["car"] * num_cars
 
-    time_matrices = {}
-    dist_matrices = {}
-    for vtype in set(vehicle_types):
-        time_matrices[vtype], dist_matrices[vtype] = create_distance_matrix(all_coords, vtype, use_cache)
+    matrices = build_matrices_for_profiles(all_coords, set(vehicle_types), use_cache, pair_cache_path, cached_only)
+    time_matrices = {vtype: time_m for vtype, (time_m, _) in matrices.items()}
+    dist_matrices = {vtype: dist_m for vtype, (_, dist_m) in matrices.items()}
+
+    lats, lons = np.asarray(all_coords, dtype=np.float64).T
+    near_center = haversine_vec(lats, lons, *CENTER_COORD) < CENTER_RADIUS_M
 
     manager = pywrapcp.RoutingIndexManager(len(all_coords), vehicle_count, DEPOT_INDEX)
     routing = pywrapcp.RoutingModel(manager)
 
+    # One transit matrix per vehicle type, shared by every vehicle of that type.
+    time_transit_idx = {}
+    dist_transit_idx = {}
+    for vtype in time_matrices:
+        time_transit_idx[vtype] = routing.RegisterTransitMatrix(
+            build_time_transits(time_matrices[vtype], vtype, near_center)
+        )
+        dist_transit_idx[vtype] = routing.RegisterTransitMatrix(build_distance_transits(dist_matrices[vtype]))
+
     time_callback_indices = []
     dist_callback_indices = []
 
     for vehicle_id in range(vehicle_count):
         vtype = vehicle_types[vehicle_id]
-        time_cb = partial(time_callback, matrix=time_matrices[vtype], vtype=vtype, manager=manager, coords=all_coords)
-        dist_cb = partial(distance_callback, matrix=dist_matrices[vtype], manager=manager)
-
-        time_cb_idx = routing.RegisterTransitCallback(time_cb)
-        dist_cb_idx = routing.RegisterTransitCallback(dist_cb)
+        time_cb_idx = time_transit_idx[vtype]
+        dist_cb_idx = dist_transit_idx[vtype]
 
         routing.SetArcCostEvaluatorOfVehicle(time_cb_idx, vehicle_id)
         routing.SetFixedCostOfVehicle(200 if vtype == "bike" else 1000, vehicle_id)
@@ -168,10 +391,9 @@ def solve_vrp(locations, vehicles_config, use_cache=False):
         if vehicle_types[vehicle_id] == "bike":
             distance_dimension.CumulVar(routing.End(vehicle_id)).SetMax(MAX_BIKE_KM * 1000)
 
-    def count_callback(from_index, to_index):
-        return int(from_index != DEPOT_INDEX)
-
-    count_cb_idx = routing.RegisterTransitCallback(count_callback)
+    # Each visited stop counts 1 and the depot 0.
+    visit_counts = [0 if node == DEPOT_INDEX else 1 for node in range(len(all_coords))]
+    count_cb_idx = routing.RegisterUnaryTransitVector(visit_counts)
     routing.AddDimension(count_cb_idx, 0, 100, True, "VisitCount")
     visit_dim = routing.GetDimensionOrDie("VisitCount")
     visit_dim.SetGlobalSpanCostCoefficient(500)
@@ -179,18 +401,30 @@ def solve_vrp(locations, vehicles_config, use_cache=False):
     total_stops = len(locations)
     min_stops = 4 if total_stops >= vehicle_count * 5 else max(1, int(total_stops / vehicle_count) - 2)
 
+    # The original count callback compared routing indices with DEPOT_INDEX,
+    # which only matches vehicle 0's start, so every other vehicle's start
+    # counted as a visit. Keep that rule: those vehicles need one stop fewer.
     for vehicle_id in range(vehicle_count):
-        visit_dim.CumulVar(routing.End(vehicle_id)).SetMin(min_stops)
+        visit_dim.CumulVar(routing.End(vehicle_id)).SetMin(min_stops if vehicle_id == 0 else min_stops - 1)
 
     for idx in range(1, len(all_coords)):
         routing.AddDisjunction([manager.NodeToIndex(idx)], 50000)
 
     search_parameters = pywrapcp.DefaultRoutingSearchParameters()
+    # PATH_CHEAPEST_ARC on purpose: SAVINGS and PARALLEL_CHEAPEST_INSERTION
+    # regularly fail to find any first solution under the VisitCount minimum,
+    # and then the solve returns no routes at all.
     search_parameters.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
     search_parameters.local_search_metaheuristic = routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
-    search_parameters.time_limit.FromSeconds(120)
+    search_parameters.time_limit.FromSeconds(min(MAX_SOLVE_SECONDS, MIN_SOLVE_SECONDS + total_stops // 2))
 
     solution = routing.SolveWithParameters(search_parameters)
+    if not solution and search_parameters.time_limit.seconds < MAX_SOLVE_SECONDS:
+        # The scaled budget is sized for local search, but on some instances
+        # the first solution alone takes longer. Retry with the full budget
+        # rather than returning no routes.
+        search_parameters.time_limit.FromSeconds(MAX_SOLVE_SECONDS)
+        solution = routing.SolveWithParameters(search_parameters)
 
     if not solution:
         return {}, {}
@@ -282,3 +516,16 @@ def haversine(coord1, coord2):
     a = sin(dlat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2) ** 2
     c = 2 * asin(sqrt(a))
     return R * c
+
+
+def haversine_vec(lats, lons, lat0, lon0):
+    """Vectorized haversine distance in meters. Arguments broadcast like
+    numpy arrays, so one call covers every node against a fixed point (or,
+    with lat0/lon0 as arrays, all pairs)."""
+    R = 6371000
+    lat1 = np.radians(lats)
+    lat2 = np.radians(lat0)
+    dlat = lat2 - lat1
+    dlon = np.radians(lon0) - np.radians(lons)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * R * np.arcsin(np.sqrt(a))
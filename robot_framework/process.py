@@ -4,18 +4,39 @@ from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConn
 from OpenOrchestrator.database.queues import QueueElement
 
 import smtplib
+import atexit
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import subprocess
 import shutil
+import filecmp
 import zipfile
+import tempfile
 import time
-from datetime import datetime
+import hashlib
+import socket
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from urllib.parse import urlsplit
+from typing import BinaryIO
 from email.message import EmailMessage
+from html import escape
 
 from robot_framework import config
-from optimize_routes import solve_vrp, get_route_details, generate_google_maps_links
+from optimize_routes import GRAPHHOPPER_URL, solve_vrp, get_route_details, generate_google_maps_links, clear_pair_cache, matrices_cached
+
+GRAPHHOPPER_DIR = Path("C:/Graphhopper")
+MAP_FILE = GRAPHHOPPER_DIR / "denmark-latest.osm.pbf"
+MAP_URL = "https://download.geofabrik.de/europe/denmark-latest.osm.pbf"
+# MD5 of the map we have. Its mtime records when it was last compared with
+# Geofabrik's, which is redone every MAP_CHECK_DAYS.
+MAP_MD5_FILE = MAP_FILE.with_name(MAP_FILE.name + ".md5")
+MAP_CHECK_DAYS = 30
+# Lives next to the map rather than in the robot's checkout, which may be
+# fresh on every run. start_graphhopper clears it when the map changes.
+PAIR_CACHE_PATH = GRAPHHOPPER_DIR / "pairs.sqlite"
 
 
 def process(orchestrator_connection: OrchestratorConnection, queue_element: QueueElement | None = None) -> None:
@@ -41,14 +62,31 @@ def process(orchestrator_connection: OrchestratorConnection, queue_element: Queu
 
     # Email recipients from inspector initials
     to_addresses = [f"{i['initial']}@aarhus.dk" for i in sorted_inspectors]
-    bccmail = orchestrator_connection.get_constant("jadt").value
+    settings = get_settings(orchestrator_connection)
+    bccmail = settings["bccmail"]
+
+    # Inspectors with an unknown vehicle type are not counted above. With no
+    # bikes or cars there is nothing to solve, so skip the API and GraphHopper.
+    if not vehicles_config["bikes"] + vehicles_config["cars"]:
+        orchestrator_connection.log_info("No bikes or cars among the selected inspectors, skipping.")
+        send_email(
+            to_address=to_addresses,
+            subject="Ingen køretøjer konfigureret",
+            body="Ingen af de valgte medarbejdere har cykel eller bil angivet, så der er ikke lagt nogle ruter i dag.",
+            bcc=bccmail,
+        )
+        return
 
     # Fetch locations from the unified tasks API
-    api_cred = orchestrator_connection.get_credential("OpenOrchestratorAPIKey")
-    api_url = api_cred.username
-    api_key = api_cred.password
+    api_url = settings["api_url"]
+    api_key = settings["api_key"]
 
-    resp = requests.get(
+    # One session for every HTTP call this run: the tasks API, the GraphHopper
+    # downloads and the readiness probes all reuse its pooled connections.
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=Retry(total=3, backoff_factor=0.5)))
+
+    resp = session.get(
         f"{api_url}tilsyn/tasks",
         headers={"X-API-Key": api_key},
         timeout=60,
@@ -108,11 +146,117 @@ def process(orchestrator_connection: OrchestratorConnection, queue_element: Queu
         )
         return
 
-    # GraphHopper setup
-    GRAPHHOPPER_DIR = Path("C:/Graphhopper")
+    # Most stops recur from day to day. If every route the solve needs is
+    # already in the pair cache, skip the JVM boot and graph load entirely.
+    profiles = {vtype for vtype, count in (("bike", vehicles_config["bikes"]), ("car", vehicles_config["cars"])) if count}
+    if pair_cache_outdated():
+        orchestrator_connection.log_info("Pair cache predates the current map; clearing it.")
+        clear_pair_cache(PAIR_CACHE_PATH)
+
+    # A due map check needs the start-up path, which also clears the pair
+    # cache if the map changed, so it must not be skipped by a warm cache.
+    cached_only = not map_check_due() and matrices_cached(locations, profiles, PAIR_CACHE_PATH)
+    if cached_only:
+        orchestrator_connection.log_info("All travel times are cached; skipping GraphHopper.")
+    elif ensure_graphhopper(orchestrator_connection, session) is None:
+        return
+
+    try:
+        routes, index_map = solve_vrp(locations, vehicles_config, pair_cache_path=PAIR_CACHE_PATH, cached_only=cached_only)
+        if not routes:
+            # Let the queue framework retry instead of mailing an empty plan.
+            raise RuntimeError("The route solver found no solution.")
+
+        # Map vehicle labels to inspector names for the email
+        vehicle_to_inspector = {}
+        bike_idx = 0
+        car_idx = 0
+        for inspector in sorted_inspectors:
+            if inspector["vehicle"] == "Cykel":
+                bike_idx += 1
+                vehicle_to_inspector[f"bike_{bike_idx}"] = inspector["initial"]
+            else:
+                car_idx += 1
+                vehicle_to_inspector[f"car_{car_idx}"] = inspector["initial"]
+
+        route_data = {}
+        for vehicle, route in routes.items():
+            details = get_route_details(route, locations)
+            vehicle_type = "bike" if vehicle.startswith("bike") else "car"
+            gmaps_links = generate_google_maps_links(route, index_map, vehicle_type)
+            inspector_initial = vehicle_to_inspector.get(vehicle, vehicle)
+
+            route_data[vehicle] = {
+                "route": route,
+                "details": details,
+                "gmaps_links": gmaps_links,
+                "vehicle_type": vehicle_type,
+                "inspector": inspector_initial,
+            }
+
+        html_body = build_html_email(route_data)
+        send_email(to_address=to_addresses, subject="Dagens ruter", body=html_body, bcc=bccmail)
+
+        orchestrator_connection.log_info("Done.")
+    except Exception as e:
+        orchestrator_connection.log_info(f"Process failed: {e}")
+        raise
+
+
+# Constants and credentials read once per robot run rather than once per
+# queue element, since every lookup is a round-trip to OpenOrchestrator.
+# Loaded on first use inside process(), so a failed lookup still goes through
+# the queue framework's retry and error handling.
+_settings: dict[str, str] = {}
+
+
+def get_settings(orchestrator_connection: OrchestratorConnection) -> dict[str, str]:
+    """Return the OpenOrchestrator settings, fetching them on the first call."""
+    if not _settings:
+        api_cred = orchestrator_connection.get_credential("OpenOrchestratorAPIKey")
+        bccmail = orchestrator_connection.get_constant("jadt").value
+        _settings.update(api_url=api_cred.username, api_key=api_cred.password, bccmail=bccmail)
+    return _settings
+
+
+# The GraphHopper JVM outlives a single queue element: booting it and loading
+# the Denmark graph takes 30-90 s, so later elements in the same run reuse it.
+# reset.kill_all stops it, and atexit covers an interpreter that exits early.
+_graphhopper: dict[str, subprocess.Popen] = {}
+
+
+def ensure_graphhopper(orchestrator_connection: OrchestratorConnection, session: requests.Session) -> subprocess.Popen | None:
+    """Return the GraphHopper process left running by an earlier queue
+    element, or start a new one. Returns None if it could not be started."""
+    gh_process = _graphhopper.get("process")
+    if gh_process is not None and gh_process.poll() is None:
+        orchestrator_connection.log_info("Reusing running GraphHopper.")
+        return gh_process
+
+    gh_process = start_graphhopper(orchestrator_connection, session)
+    if gh_process is None:
+        _graphhopper.pop("process", None)
+    else:
+        _graphhopper["process"] = gh_process
+    return gh_process
+
+
+def close_graphhopper() -> None:
+    """Stop the shared GraphHopper process, if one is running."""
+    gh_process = _graphhopper.pop("process", None)
+    if gh_process is not None:
+        stop_graphhopper(gh_process)
+
+
+atexit.register(close_graphhopper)
+
+
+def start_graphhopper(orchestrator_connection: OrchestratorConnection, session: requests.Session) -> subprocess.Popen | None:
+    """Make sure GraphHopper, the Denmark map and a JRE are in place, launch
+    the server and wait until it answers. Returns the running process, or
+    None if it died or did not come up in time."""
     GRAPHHOPPER_JAR = GRAPHHOPPER_DIR / "graphhopper-web-11.0.jar"
     GRAPHHOPPER_JAR_URL = "https://github.com/graphhopper/graphhopper/releases/download/11.0/graphhopper-web-11.0.jar"
-    MAP_FILE = GRAPHHOPPER_DIR / "denmark-latest.osm.pbf"
     CONFIG_SOURCE = Path("config.yml")
     CONFIG_DEST = GRAPHHOPPER_DIR / "config.yml"
     JDK_DIR = GRAPHHOPPER_DIR / "jdk"
@@ -136,53 +280,59 @@ def process(orchestrator_connection: OrchestratorConnection, queue_element: Queu
             orchestrator_connection.log_info("Removing graph-cache built by old GraphHopper version.")
             shutil.rmtree(cache_dir)
 
+    jdk_zip_url = "https://github.com/adoptium/temurin17-binaries/releases/download/jdk-17.0.10%2B7/OpenJDK17U-jre_x64_windows_hotspot_17.0.10_7.zip"
+
+    refresh_map = not MAP_FILE.exists()
+    if not refresh_map and map_check_due():
+        # Geofabrik publishes an .md5 next to each extract. Only re-download
+        # when it differs from the one recorded at our last download.
+        known_md5 = MAP_MD5_FILE.read_text().strip() if MAP_MD5_FILE.exists() else None
+        remote_md5 = fetch_md5(MAP_URL, session)
+        refresh_map = known_md5 is None or (remote_md5 is not None and remote_md5 != known_md5)
+        if remote_md5 is not None and remote_md5 == known_md5:
+            # Unchanged: restart the MAP_CHECK_DAYS clock. If Geofabrik could
+            # not be reached the check stays due and is retried next run.
+            MAP_MD5_FILE.touch()
+
+    # The three artifacts are independent, so fetch them concurrently:
+    # total wait is the slowest download instead of the sum of all three.
+    downloads = {}
     if not GRAPHHOPPER_JAR.exists():
         orchestrator_connection.log_info("Downloading GraphHopper JAR...")
-        r = requests.get(GRAPHHOPPER_JAR_URL, stream=True)
-        with open(GRAPHHOPPER_JAR, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
+        downloads["jar"] = (GRAPHHOPPER_JAR_URL, GRAPHHOPPER_JAR)
+    if refresh_map:
+        orchestrator_connection.log_info("Downloading latest Denmark map...")
+        downloads["map"] = (MAP_URL, MAP_FILE)
+    install_java = not JAVA_BIN.exists()
+    if install_java:
+        orchestrator_connection.log_info("Downloading Adoptium JDK...")
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        futures = {name: pool.submit(download_file, url, dest, session) for name, (url, dest) in downloads.items()}
+        if install_java:
+            # Unpack in the worker as soon as the zip lands, overlapping the
+            # (much larger) map download instead of waiting for it.
+            futures["jdk"] = pool.submit(install_jdk, jdk_zip_url, JDK_DIR, session)
+        # Compare contents rather than mtimes: the robot's checkout is often
+        # fresh, which would make the repo copy look newer on every run.
+        if not CONFIG_DEST.exists() or not filecmp.cmp(CONFIG_SOURCE, CONFIG_DEST, shallow=False):
+            shutil.copyfile(CONFIG_SOURCE, CONFIG_DEST)
+        digests = {name: future.result() for name, future in futures.items()}
+
+    if "jar" in digests:
         # Ensure graph-cache is rebuilt against the freshly downloaded JAR.
         cache_dir = GRAPHHOPPER_DIR / "graph-cache"
         if cache_dir.exists():
             orchestrator_connection.log_info("Removing graph-cache after GraphHopper JAR download.")
             shutil.rmtree(cache_dir)
 
-    shutil.copy(CONFIG_SOURCE, CONFIG_DEST)
-
-    map_url = "https://download.geofabrik.de/europe/denmark-latest.osm.pbf"
-    if not MAP_FILE.exists() or datetime.today().day == 1:
-        orchestrator_connection.log_info("Downloading latest Denmark map...")
-        r = requests.get(map_url, stream=True)
-        with open(MAP_FILE, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
+    if "map" in digests:
+        MAP_MD5_FILE.write_text(digests["map"])
         cache_dir = GRAPHHOPPER_DIR / "graph-cache"
         if cache_dir.exists():
             shutil.rmtree(cache_dir)
-
-    if not JAVA_BIN.exists():
-        orchestrator_connection.log_info("Downloading Adoptium JDK...")
-        jdk_zip_url = "https://github.com/adoptium/temurin17-binaries/releases/download/jdk-17.0.10%2B7/OpenJDK17U-jre_x64_windows_hotspot_17.0.10_7.zip"
-        jdk_zip_path = GRAPHHOPPER_DIR / "jdk.zip"
-        r = requests.get(jdk_zip_url, stream=True)
-        with open(jdk_zip_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-        with zipfile.ZipFile(jdk_zip_path, "r") as zip_ref:
-            extract_temp = GRAPHHOPPER_DIR / "jdk_temp"
-            extract_temp.mkdir(exist_ok=True)
-            zip_ref.extractall(extract_temp)
-            subdirs = [d for d in extract_temp.iterdir() if d.is_dir()]
-            if subdirs:
-                JDK_DIR.mkdir(exist_ok=True)
-                for item in subdirs[0].iterdir():
-                    shutil.move(str(item), str(JDK_DIR))
-            shutil.rmtree(extract_temp)
-        jdk_zip_path.unlink()
+        # Cached travel times were routed on the old map.
+        clear_pair_cache(PAIR_CACHE_PATH)
 
     # Launch GraphHopper and solve
     orchestrator_connection.log_info("Launching GraphHopper server...")
@@ -199,77 +349,155 @@ def process(orchestrator_connection: OrchestratorConnection, queue_element: Queu
     gh_process = subprocess.Popen(
         java_cmd,
         cwd=GRAPHHOPPER_DIR,
+        stdin=subprocess.DEVNULL,
         stdout=subprocess.DEVNULL,
         stderr=subprocess.DEVNULL,
+        close_fds=True,
+        # No console window for the JVM; the flag only exists on Windows.
+        creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0),
     )
     try:
         orchestrator_connection.log_info("Waiting for GraphHopper to be ready (first run after upgrade rebuilds the graph-cache, up to 20 min)...")
         ready = False
+        # Probe with a bare TCP connect until Jetty accepts on the port (it only
+        # binds once the graph is loaded), then confirm with one GET /health.
         # Wait up to 30 min — graph import for Denmark can take a while.
-        for iteration in range(900):
+        # Poll with exponential backoff: a server that is up within a second
+        # is noticed almost immediately, a long graph import settles at one
+        # probe every 2s.
+        started = time.monotonic()
+        deadline = started + 30 * 60
+        next_heartbeat = started + 30
+        delay = 0.1
+        gh_address = urlsplit(GRAPHHOPPER_URL)
+        while time.monotonic() < deadline:
             # Abort early if the Java process died.
             if gh_process.poll() is not None:
                 orchestrator_connection.log_info(
                     f"GraphHopper exited during startup with code {gh_process.returncode}. "
                     f"Re-enable stdout/stderr piping in process.py to diagnose."
                 )
-                return
-            try:
-                if requests.get("http://localhost:8989/", timeout=2).status_code == 200:
-                    ready = True
-                    break
-            except Exception:
-                pass
+                return None
+            if port_open(gh_address.hostname, gh_address.port):
+                try:
+                    if session.get(f"{GRAPHHOPPER_URL}/health", timeout=(0.2, 0.5)).status_code == 200:
+                        ready = True
+                        break
+                except Exception:
+                    pass
             # Heartbeat every 30s so the robot log shows progress.
-            if iteration > 0 and iteration % 15 == 0:
-                orchestrator_connection.log_info(f"Still waiting for GraphHopper... ({iteration * 2}s elapsed)")
-            time.sleep(2)
+            if time.monotonic() >= next_heartbeat:
+                orchestrator_connection.log_info(f"Still waiting for GraphHopper... ({int(time.monotonic() - started)}s elapsed)")
+                next_heartbeat += 30
+            time.sleep(delay)
+            delay = min(delay * 1.5, 2.0)
 
         if not ready:
             orchestrator_connection.log_info("GraphHopper did not start in time.")
-            gh_process.kill()
-            return
+            stop_graphhopper(gh_process)
+            return None
 
         orchestrator_connection.log_info("GraphHopper is running!")
+    except BaseException:
+        stop_graphhopper(gh_process)
+        raise
+    return gh_process
 
-        routes, index_map = solve_vrp(locations, vehicles_config)
-
-        # Map vehicle labels to inspector names for the email
-        vehicle_to_inspector = {}
-        bike_idx = 0
-        car_idx = 0
-        for inspector in sorted_inspectors:
-            if inspector["vehicle"] == "Cykel":
-                bike_idx += 1
-                vehicle_to_inspector[f"bike_{bike_idx}"] = inspector["initial"]
-            else:
-                car_idx += 1
-                vehicle_to_inspector[f"car_{car_idx}"] = inspector["initial"]
-
-        route_data = {}
-        for vehicle, route in routes.items():
-            details = get_route_details(route, locations)
-            vehicle_type = "bike" if vehicle.startswith("bike") else "car"
-            gmaps_links = generate_google_maps_links(route, index_map, vehicle_type)
-            inspector_initial = vehicle_to_inspector.get(vehicle, vehicle)
-
-            route_data[vehicle] = {
-                "route": route,
-                "details": details,
-                "gmaps_links": gmaps_links,
-                "vehicle_type": vehicle_type,
-                "inspector": inspector_initial,
-            }
 
-        html_body = build_html_email(route_data)
-        send_email(to_address=to_addresses, subject="Dagens ruter", body=html_body, bcc=bccmail)
-
-        orchestrator_connection.log_info("Done.")
-    except Exception as e:
-        orchestrator_connection.log_info(f"Process failed: {e}")
-        raise
-    finally:
+def stop_graphhopper(gh_process: subprocess.Popen) -> None:
+    """Kill the GraphHopper JVM and wait for it to exit, so port 8989 is
+    free again before the next start."""
+    try:
         gh_process.kill()
+    finally:
+        try:
+            gh_process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            pass
+
+
+def port_open(host: str, port: int) -> bool:
+    """Return True if something accepts TCP connections on host:port."""
+    with socket.socket() as s:
+        s.settimeout(0.2)
+        return s.connect_ex((host, port)) == 0
+
+
+def map_check_due() -> bool:
+    """True if the map is missing, or was last compared with Geofabrik's more
+    than MAP_CHECK_DAYS ago."""
+    if not MAP_FILE.exists() or not MAP_MD5_FILE.exists():
+        return True
+    return time.time() - MAP_MD5_FILE.stat().st_mtime > MAP_CHECK_DAYS * 24 * 60 * 60
+
+
+def pair_cache_outdated() -> bool:
+    """True if the pair cache was last written before the current map arrived.
+    start_graphhopper clears it right after a map download; this catches a run
+    that stopped in between, so neither routed times nor cached "no route"
+    answers outlive the map they came from."""
+    if not PAIR_CACHE_PATH.exists() or not MAP_FILE.exists():
+        return False
+    return PAIR_CACHE_PATH.stat().st_mtime < MAP_FILE.stat().st_mtime
+
+
+def download_file(url: str, dest: Path, session: requests.Session | None = None) -> str:
+    """Stream url to dest in 1 MiB chunks and return the file's MD5 hex digest.
+    Writes to a .part file first so an interrupted download never leaves a
+    truncated file at dest that later runs would mistake for complete."""
+    part = dest.with_name(dest.name + ".part")
+    with open(part, "wb") as f:
+        digest = stream_download(url, f, session)
+    part.replace(dest)
+    return digest
+
+
+def stream_download(url: str, f: BinaryIO, session: requests.Session | None = None) -> str:
+    """Write the body of url to the open file f in 1 MiB chunks and return its MD5 hex digest."""
+    digest = hashlib.md5()
+    with (session or requests).get(url, stream=True, timeout=60) as r:
+        r.raise_for_status()
+        for chunk in r.iter_content(chunk_size=1 << 20):
+            f.write(chunk)
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def install_jdk(url: str, jdk_dir: Path, session: requests.Session | None = None) -> str:
+    """Download the JRE zip and unpack its single top-level folder into jdk_dir.
+    Returns the zip's MD5 hex digest."""
+    # The zip is only read once, so buffer it in memory (spilling to a temp
+    # file past 256 MiB) rather than staging it on disk next to the JRE.
+    with tempfile.SpooledTemporaryFile(max_size=256 << 20) as buf:
+        digest = stream_download(url, buf, session)
+        buf.seek(0)
+        extract_jdk(buf, jdk_dir)
+    return digest
+
+
+def extract_jdk(zip_file: BinaryIO, jdk_dir: Path) -> None:
+    """Unpack zip_file into jdk_dir, dropping the archive's top-level folder."""
+    # Write each entry straight to its final place with the top-level folder
+    # stripped, instead of extractall into a temp dir + move + rmtree.
+    with zipfile.ZipFile(zip_file, "r") as zip_ref:
+        for info in zip_ref.infolist():
+            rel = Path(*Path(info.filename).parts[1:])
+            if info.is_dir() or not rel.parts or ".." in rel.parts:
+                continue
+            target = jdk_dir / rel
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with zip_ref.open(info) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst, length=1 << 20)
+
+
+def fetch_md5(url: str, session: requests.Session | None = None) -> str | None:
+    """Return the MD5 published at url + ".md5", or None if it can't be fetched."""
+    try:
+        r = (session or requests).get(url + ".md5", timeout=30)
+        r.raise_for_status()
+        return r.text.split()[0]
+    except Exception:
+        return None
 
 
 def build_html_email(route_data):
@@ -308,21 +536,16 @@ def build_html_email(route_data):
             <tbody>
         """)
 
+        # Fields from the tasks API may be missing or null, and the free text
+        # comes straight from case data, so default and escape every cell.
         for stop in details:
-            case_ref = stop.get("løbenummer", "")
+            case_ref = escape(str(stop.get("løbenummer") or ""))
             case_url = stop.get("case_url")
             if case_ref and case_url:
-                case_cell = f'<a href="{case_url}" target="_blank">{case_ref}</a>'
-            else:
-                case_cell = case_ref
-            html_parts.append(f"""
-                <tr>
-                    <td>{stop['Stop #']}</td>
-                    <td>{case_cell}</td>
-                    <td>{stop.get('adresse', 'Depot')}</td>
-                    <td>{stop.get('forseelse', '')}</td>
-                </tr>
-            """)
+                case_ref = f'<a href="{escape(case_url)}" target="_blank">{case_ref}</a>'
+            address = escape(str(stop.get("adresse") or "Ikke angivet"))
+            info = escape(str(stop.get("forseelse") or ""))
+            html_parts.append(f"<tr><td>{stop['Stop #']}</td><td>{case_ref}</td><td>{address}</td><td>{info}</td></tr>")
 
         html_parts.append("</tbody></table>")
 
@@ -340,6 +563,41 @@ def send_email(to_address: str | list[str], subject: str, body: str, bcc: str):
     msg.set_content("Please enable HTML to view this message.")
     msg.add_alternative(body, subtype="html")
 
-    with smtplib.SMTP(config.SMTP_SERVER, config.SMTP_PORT) as smtp:
-        smtp.starttls()
-        smtp.send_message(msg)
+    try:
+        _smtp_connection().send_message(msg)
+    except smtplib.SMTPServerDisconnected:
+        # The server dropped the cached connection between NOOP and send.
+        close_smtp()
+        _smtp_connection().send_message(msg)
+
+
+# One STARTTLS connection per (host, port), reused across queue elements so
+# the TLS handshake is paid once per robot run instead of once per email.
+_smtp_connections: dict[tuple[str, int], smtplib.SMTP] = {}
+
+
+def _smtp_connection() -> smtplib.SMTP:
+    key = (config.SMTP_SERVER, config.SMTP_PORT)
+    smtp = _smtp_connections.get(key)
+    if smtp is not None:
+        try:
+            if smtp.noop()[0] == 250:
+                return smtp
+        except (smtplib.SMTPException, OSError):
+            pass
+        close_smtp()
+
+    smtp = smtplib.SMTP(*key)
+    smtp.starttls()
+    _smtp_connections[key] = smtp
+    return smtp
+
+
+def close_smtp():
+    """Close any cached SMTP connection. Safe to call when none is open."""
+    while _smtp_connections:
+        _, smtp = _smtp_connections.popitem()
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
@@ -2,6 +2,8 @@
 
 from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
 
+from robot_framework import process
+
 
 def reset(orchestrator_connection: OrchestratorConnection) -> None:
     """Clean up, close/kill all programs and start them again. """
@@ -20,11 +22,13 @@ def clean_up(orchestrator_connection: OrchestratorConnection) -> None:
 def close_all(orchestrator_connection: OrchestratorConnection) -> None:
     """Gracefully close all applications used by the robot."""
     orchestrator_connection.log_trace("Closing all applications.")
+    process.close_smtp()
 
 
 def kill_all(orchestrator_connection: OrchestratorConnection) -> None:
     """Forcefully close all applications used by the robot."""
     orchestrator_connection.log_trace("Killing all applications.")
+    process.close_graphhopper()
 
 
 def open_all(orchestrator_connection: OrchestratorConnection) -> None: